@@ -1,144 +1,713 @@
 import os
+import queue
+import multiprocessing as mp
+import logging
+import threading
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import boto3
 import h5py
 import numpy as np
 import pyarrow as pa
+import lance
 import lancedb
 import time
 from tqdm import tqdm
 from PIL import Image
-import io
+import simplejpeg
+import tifffile
+import zarr
 
 import openslide
 
-def find_wsi_file(wsi_dir, wsi_id):
+
+# Quality of the JPEG encoded patches
+JPEG_QUALITY = 85
+
+# Lance file format version; 2.1 has cheaper random access to wide binary columns
+LANCE_STORAGE_VERSION = '2.1'
+
+# Rows per Lance data file, so the dataset ends up in few large fragments
+MAX_ROWS_PER_FILE = 1_000_000
+
+# Lance compression of the image column for raw patches. Lance only applies it to
+# variable width columns, so raw patches are stored as binary rather than as tensors
+RAW_IMAGE_METADATA = {
+    'lance-encoding:compression': 'zstd',
+    'lance-encoding:compression-level': '3'
+}
+
+# Upper bounds for the size of a batch of raw patches and for all raw batches in the queue,
+# since raw patches are much larger than JPEGs (192 KB for a 256 px patch)
+RAW_BATCH_BYTES = 64 * 1024 * 1024
+RAW_QUEUE_BYTES = 1024 * 1024 * 1024
+
+# Errors raised by the WSI readers for unreadable files or regions; corrupt tiles read
+# through tifffile raise imagecodecs errors, which are RuntimeErrors
+WSI_READ_ERRORS = (openslide.OpenSlideError, OSError, RuntimeError, tifffile.TiffFileError)
+
+LOG_FORMAT = '%(levelname)s: %(message)s'
+
+# Seconds between checks for an aborted run while waiting on the batch queue
+QUEUE_POLL_INTERVAL = 1.0
+
+logger = logging.getLogger(__name__)
+
+# Queue and abort event shared with the worker processes, set by _init_worker
+_batch_queue = None
+_abort_event = None
+
+
+class _WriteAborted(Exception):
+    """Raised in the writer and the workers when the run has been aborted."""
+
+
+def _patch_schema(image_encoding='jpeg', patch_size=256):
+    """
+    Define the schema of the LanceDB patch table.
+    
+    Args:
+        image_encoding: 'jpeg' to store JPEG bytes, or 'raw' to store the RGB pixels of every patch as
+            (patch_size, patch_size, 3) uint8 bytes compressed by Lance with zstd (default: 'jpeg')
+        patch_size: Width and height of the patches, only used for 'raw' and kept in the
+            schema metadata under 'patch_size' to reshape the bytes (default: 256)
+    """
+    metadata = None
+    if image_encoding == 'raw':
+        image_field = pa.field('image', pa.binary(), metadata=RAW_IMAGE_METADATA)
+        metadata = {'patch_size': str(patch_size)}
+    else:
+        image_field = pa.field('image', pa.binary())
+    
+    return pa.schema([
+        ('wsi_id', pa.string()),
+        ('patch_idx', pa.int64()),
+        ('coord_x', pa.int64()),
+        ('coord_y', pa.int64()),
+        image_field
+    ], metadata=metadata)
+
+
+class TiffZarrSlide:
     """
-    Find the WSI file corresponding to a given WSI ID.
+    Minimal stand-in for openslide.OpenSlide that reads pyramidal TIFFs through tifffile and zarr.
+    Regions are sliced from the tiled TIFF pages as numpy arrays, skipping OpenSlide's RGBA
+    buffer and tile cache. Only the parts of the OpenSlide interface used by this script are provided.
+    Unlike OpenSlide, sub-pixel locations on levels above 0 are not interpolated, so only
+    locations on the pixel grid of the level can be read.
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path (str): fullpath to the pyramidal TIFF file
+        """
+        self._tif = tifffile.TiffFile(path)
+        series = self._tif.series[0]
+        if series.axes != 'YXS':
+            self._tif.close()
+            raise ValueError(f"Unsupported TIFF axes {series.axes} in {path}, expected YXS")
+        
+        self._series = series
+        self._levels = {}
+        self._lock = threading.RLock()
+        
+        width = series.levels[0].shape[1]
+        height = series.levels[0].shape[0]
+        self.level_downsamples = tuple(
+            (width / level.shape[1] + height / level.shape[0]) / 2 for level in series.levels
+        )
+        
+        # Tile sizes under the same keys as OpenSlide
+        self.properties = {}
+        for i, level in enumerate(series.levels):
+            if level.keyframe.is_tiled:
+                self.properties[f'openslide.level[{i}].tile-width'] = str(level.keyframe.tilewidth)
+                self.properties[f'openslide.level[{i}].tile-height'] = str(level.keyframe.tilelength)
+    
+    def _level_array(self, level):
+        with self._lock:
+            if level not in self._levels:
+                store = self._series.aszarr(level=level, lock=self._lock)
+                self._levels[level] = (store, zarr.open(store, mode='r'))
+            return self._levels[level][1]
+    
+    def on_level_grid(self, coords, level):
+        """
+        Check whether level 0 coordinates lie on the pixel grid of a level (within 0.01 pixels),
+        so that they can be read without interpolation.
+        """
+        pos = np.asarray(coords, dtype=np.float64) / self.level_downsamples[level]
+        return bool(np.all(np.abs(pos - np.round(pos)) <= 0.01))
+    
+    def read_region(self, location, level, size):
+        """
+        Read a region like OpenSlide.read_region, but return it as an RGB numpy array.
+        Parts of the region outside the slide are filled with zeros.
+        Raises ValueError if the location is not on the pixel grid of the level.
+        """
+        if not self.on_level_grid(location, level):
+            raise ValueError(f"Location {location} is not on the pixel grid of level {level}")
+        
+        array = self._level_array(level)
+        downsample = self.level_downsamples[level]
+        x = int(round(location[0] / downsample))
+        y = int(round(location[1] / downsample))
+        w, h = size
+        
+        region = array[y:y + h, x:x + w]
+        if region.shape[:2] != (h, w):
+            padded = np.zeros((h, w, region.shape[2]), dtype=region.dtype)
+            padded[:region.shape[0], :region.shape[1]] = region
+            region = padded
+        return region
+    
+    def close(self):
+        for store, _ in self._levels.values():
+            store.close()
+        self._tif.close()
+
+
+def _try_open_wsi(wsi_path, reader='openslide'):
+    """
+    Open a WSI file with the given reader ('openslide' or 'tifffile').
+    Returns None if the file cannot be opened.
+    """
+    try:
+        if reader == 'tifffile':
+            return TiffZarrSlide(wsi_path)
+        return openslide.OpenSlide(wsi_path)
+    except WSI_READ_ERRORS + (ValueError,) as e:
+        logger.warning(f"Could not open WSI file {wsi_path}: {e}")
+        return None
+
+
+def _native_tile_size(wsi, level):
+    """
+    Get the (width, height) of the native tiles of a pyramid level, or None if the slide does not report it.
+    """
+    try:
+        return (int(wsi.properties[f'openslide.level[{level}].tile-width']),
+                int(wsi.properties[f'openslide.level[{level}].tile-height']))
+    except (KeyError, ValueError):
+        return None
+
+
+def _tile_order(coords, tile_size, downsample):
+    """
+    Get the order that traverses the patches tile by tile, row-major over the tiles.
+    The sort is stable, so patches within a tile keep their original order.
+    
+    Args:
+        coords: (N, 2) array of patch coordinates at level 0
+        tile_size: (width, height) of the tiles
+        downsample: Downsample factor of the patch level
+    
+    Returns:
+        int64 array of indices into coords
     """
-    return os.path.join(wsi_dir, f"{wsi_id}.tif")
+    tile_w, tile_h = tile_size
+    tile_x = (coords[:, 0] // downsample) // tile_w
+    tile_y = (coords[:, 1] // downsample) // tile_h
+    return np.lexsort((tile_x, tile_y)).astype(np.int64)
 
 
-def process_h5_patches(h5_dir, wsi_dir, db_path="./lancedb", table_name="wsi_patches"):
+def _group_by_tile(batch_coords, tile_size, downsample):
+    """
+    Group the patches of a batch by the native tile their top left corner falls into.
+    Patches are only grouped if the tile size is known and the level downsample is
+    integral, since slicing patches out of a shared region is otherwise not pixel-exact.
+    
+    Args:
+        batch_coords: (N, 2) array of patch coordinates at level 0
+        tile_size: (width, height) of the native tiles, or None
+        downsample: Downsample factor of the patch level
+    
+    Returns:
+        List of lists of indices into batch_coords
+    """
+    if tile_size is None or downsample != int(downsample):
+        return [[i] for i in range(len(batch_coords))]
+    
+    downsample = int(downsample)
+    tile_w, tile_h = tile_size
+    xs = batch_coords[:, 0].tolist()
+    ys = batch_coords[:, 1].tolist()
+    
+    groups = {}
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        # Patches sharing a tile also need the same sub-pixel phase to be sliced exactly
+        key = (x % downsample, y % downsample, (x // downsample) // tile_w, (y // downsample) // tile_h)
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+def _decode_and_encode(wsi, patch_level, patch_size, downsample, image_encoding, group_coords):
+    """
+    Read a group of patches from the WSI with a single read_region call and encode them.
+    Reading the region spanning all patches of a group decodes each native tile once
+    instead of once per patch overlapping it.
+    
+    Args:
+        wsi: Open OpenSlide handle or TiffZarrSlide
+        patch_level: Pyramid level to read the patches from
+        patch_size: Width and height of the patches in pixels
+        downsample: Downsample factor of the patch level
+        image_encoding: 'jpeg' to return JPEG bytes, or 'raw' to return RGB arrays
+        group_coords: (N, 2) int64 array of the top left corners at level 0
+    
+    Returns:
+        One JPEG bytes object or RGB array per patch, or None for patches that could not be read
+    """
+    downsample = int(round(downsample))
+    x0, y0 = group_coords.min(axis=0)
+    
+    # Offsets of the patches within the region, in pixels of the patch level
+    offsets = (group_coords - (x0, y0)) // downsample
+    region_w, region_h = offsets.max(axis=0) + patch_size
+    offsets = offsets.tolist()
+    
+    # Extract region from WSI using read_region
+    # read_region takes (x, y) at level 0, level, and size; OpenSlide needs Python ints here
+    try:
+        region = wsi.read_region((int(x0), int(y0)), patch_level, (int(region_w), int(region_h)))
+        region = np.asarray(region, dtype=np.uint8)
+    except WSI_READ_ERRORS as e:
+        logger.warning(f"Could not read {len(offsets)} patches at ({x0}, {y0}) on level {patch_level}: {e}")
+        return [None] * len(offsets)
+    
+    if image_encoding == 'raw':
+        # Views only, the caller copies them into the batch buffer
+        return [region[oy:oy + patch_size, ox:ox + patch_size, :3] for ox, oy in offsets]
+    
+    # Encode to JPEG with libjpeg-turbo, which skips the alpha channel of
+    # OpenSlide regions itself, so no RGB copy of the patch is needed
+    colorspace = 'RGBA' if region.shape[2] == 4 else 'RGB'
+    img_bytes = []
+    for ox, oy in offsets:
+        patch = np.ascontiguousarray(region[oy:oy + patch_size, ox:ox + patch_size])
+        img_bytes.append(simplejpeg.encode_jpeg(patch, quality=JPEG_QUALITY, colorspace=colorspace, fastdct=True))
+    return img_bytes
+
+
+def _split_s3_path(path):
+    """
+    Split an s3://bucket/key path into bucket and key.
+    """
+    bucket, _, key = path[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def _s3_credentials():
+    """
+    Credentials of the default boto3 session in the form expected by h5coro.
+    """
+    credentials = boto3.Session().get_credentials()
+    if credentials is None:
+        return {}
+    credentials = credentials.get_frozen_credentials()
+    return {
+        'aws_access_key_id': credentials.access_key,
+        'aws_secret_access_key': credentials.secret_key,
+        'aws_session_token': credentials.token
+    }
+
+
+def _list_h5_files(h5_dir):
+    """
+    List the paths of all H5 files in a local directory or under an s3:// prefix.
+    """
+    if not h5_dir.startswith('s3://'):
+        return [os.path.join(h5_dir, f) for f in os.listdir(h5_dir) if f.endswith('.h5')]
+    
+    bucket, prefix = _split_s3_path(h5_dir)
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    
+    h5_paths = []
+    paginator = boto3.client('s3').get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.h5'):
+                h5_paths.append(f"s3://{bucket}/{obj['Key']}")
+    return h5_paths
+
+
+def _index_wsi_files(wsi_dir):
+    """
+    Map the WSI ID of every WSI file in a directory to its path, with a single directory scan.
+    """
+    with os.scandir(wsi_dir) as entries:
+        return {os.path.splitext(entry.name)[0]: entry.path for entry in entries if entry.name.endswith('.tif')}
+
+
+def _read_coords(h5_path, metadata_only=False):
+    """
+    Read all patch coordinates and the patch metadata from an H5 file.
+    H5 files on S3 (s3:// paths) are read with h5coro, which fetches the whole
+    dataset with a few coalesced range requests instead of one request per chunk.
+    
+    Args:
+        h5_path: Path to the H5 patch file
+        metadata_only: Only read the patch metadata and return None for the coordinates (default: False)
+    
+    Returns:
+        (coords, patch_level, patch_size), or None if the file has no 'coords' dataset
+    """
+    attrs = {}
+    
+    if h5_path.startswith('s3://'):
+        # h5coro is only needed for H5 files on S3 (installed with the 's3' extra)
+        from h5coro import h5coro, s3driver
+
+        bucket, key = _split_s3_path(h5_path)
+        h5obj = h5coro.H5Coro(f"{bucket}/{key}", s3driver.S3Driver, credentials=_s3_credentials())
+
+        # Listing the root returns each dataset together with its attributes
+        variables, _, _ = h5obj.list('/', w_attr=True)
+        if 'coords' not in variables:
+            return None
+
+        attrs = {name: value for name, value in variables['coords'].items() if name != '__metadata__'}
+        coords = None if metadata_only else h5obj.readDatasets(['coords'], block=True)['coords']
+    else:
+        with h5py.File(h5_path, 'r') as hdf5_file:
+            if 'coords' not in hdf5_file:
+                return None
+            
+            # Read all coordinates at once instead of one HDF5 lookup per patch
+            coords = None if metadata_only else hdf5_file['coords'][...]
+            attrs = dict(hdf5_file['coords'].attrs)
+    
+    # Get patch metadata from H5 attributes
+    if 'patch_level' in attrs:
+        patch_level = int(np.squeeze(attrs['patch_level']))
+    else:
+        patch_level = 0  # Default to level 0
+    
+    if 'patch_size' in attrs:
+        patch_size = int(np.squeeze(attrs['patch_size']))
+    else:
+        patch_size = 256  # Default patch size
+    
+    return coords, patch_level, patch_size
+
+
+def _process_one_wsi(h5_path, wsi_path, schema, batch_size=1000, num_threads=8, reader='openslide'):
+    """
+    Extract the patches of a single WSI and yield them as Arrow record batches.
+    Reads coordinates from the H5 file and patches from the corresponding WSI file.
+    
+    Args:
+        h5_path: Path to the H5 patch file (local or s3://)
+        wsi_path: Path to the WSI file
+        schema: Schema of the record batches, see _patch_schema
+        batch_size: Number of patches per record batch (default: 1000)
+        num_threads: Number of threads reading patches from the WSI (default: 8)
+        reader: Library used to read the WSI, 'openslide' or 'tifffile' (default: 'openslide')
+    """
+    h5_filename = os.path.basename(h5_path)
+    
+    # Extract WSI ID from H5 filename (remove .h5 extension)
+    wsi_id = os.path.splitext(h5_filename)[0]
+    
+    # Read coordinates and metadata from H5 file
+    coords_info = _read_coords(h5_path)
+    if coords_info is None:
+        logger.warning(f"{h5_filename} missing 'coords' dataset, skipping")
+        return
+    
+    all_coords, patch_level, patch_size = coords_info
+    all_coords = np.asarray(all_coords).astype(np.int64, copy=False)
+    xs = np.ascontiguousarray(all_coords[:, 0])
+    ys = np.ascontiguousarray(all_coords[:, 1])
+    num_patches = len(all_coords)
+    
+    # Only raw tables carry a patch size in their schema metadata
+    table_patch_size = (schema.metadata or {}).get(b'patch_size')
+    image_encoding = 'jpeg' if table_patch_size is None else 'raw'
+    if image_encoding == 'raw' and int(table_patch_size) != patch_size:
+        raise ValueError(f"Patch size {patch_size} of {h5_filename} does not match the table "
+                         f"patch size {int(table_patch_size)}")
+    
+    logger.info(f"Processing {num_patches} patches from {wsi_id} (level={patch_level}, size={patch_size})")
+    
+    # Open WSI file (handles cannot be shared across processes,
+    # but are thread-safe and release the GIL while decoding tiles)
+    wsi = _try_open_wsi(wsi_path, reader)
+    if wsi is None:
+        return
+    
+    try:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            tile_size = _native_tile_size(wsi, patch_level)
+            downsample = wsi.level_downsamples[patch_level]
+            # The tifffile reader would otherwise give different pixels than OpenSlide, which interpolates
+            if isinstance(wsi, TiffZarrSlide) and not wsi.on_level_grid(all_coords, patch_level):
+                raise ValueError(f"Coordinates of {h5_filename} are not on the pixel grid of level {patch_level}, "
+                                 f"which the tifffile reader cannot read; use the openslide reader instead")
+            read_group = partial(_decode_and_encode, wsi, patch_level, patch_size, downsample, image_encoding)
+            
+            # Traverse patches in tile order, so co-located patches share a batch and the tile cache;
+            # patch_idx keeps the original H5 index
+            order = _tile_order(all_coords, tile_size or (patch_size, patch_size), downsample)
+            
+            # Process in batches for efficiency
+            for batch_start in range(0, num_patches, batch_size):
+                batch_end = min(batch_start + batch_size, num_patches)
+                num_batch = batch_end - batch_start
+                
+                # Column arrays for the batch; fancy indexing gives fresh arrays that Arrow wraps without copying
+                patch_idx = order[batch_start:batch_end]
+                coord_x = xs[patch_idx]
+                coord_y = ys[patch_idx]
+                batch_xy = all_coords[patch_idx]
+                
+                # Read and encode the patches concurrently, one read_region per native tile group
+                groups = _group_by_tile(batch_xy, tile_size, downsample)
+                group_results = pool.map(read_group, [batch_xy[group] for group in groups])
+                
+                images = [None] * num_batch
+                for group, encoded in zip(groups, group_results):
+                    for i, image in zip(group, encoded):
+                        images[i] = image
+                
+                # Drop the patches that could not be read
+                valid = np.array([image is not None for image in images])
+                if not valid.all():
+                    patch_idx, coord_x, coord_y = patch_idx[valid], coord_x[valid], coord_y[valid]
+                    images = [image for image in images if image is not None]
+                    num_batch = len(images)
+                    if num_batch == 0:
+                        continue
+                
+                if image_encoding == 'raw':
+                    # Stack into one (B, H, W, 3) array that the binary column wraps without copying,
+                    # with every patch taking the same number of bytes
+                    pixels = np.stack(images)
+                    offsets = np.arange(num_batch + 1, dtype=np.int32) * pixels[0].nbytes
+                    image_array = pa.Array.from_buffers(pa.binary(), num_batch,
+                                                        [None, pa.py_buffer(offsets), pa.py_buffer(pixels)])
+                else:
+                    image_array = pa.array(images, type=pa.binary())
+                
+                yield pa.record_batch([
+                    pa.array([wsi_id] * num_batch, type=pa.string()),
+                    pa.array(patch_idx, type=pa.int64()),
+                    pa.array(coord_x, type=pa.int64()),
+                    pa.array(coord_y, type=pa.int64()),
+                    image_array
+                ], schema=schema)
+    finally:
+        wsi.close()
+
+
+def _init_worker(batch_queue, abort_event):
+    """
+    Initialize a worker process with the queue that batches are sent to and the abort event.
+    """
+    global _batch_queue, _abort_event
+    _batch_queue = batch_queue
+    _abort_event = abort_event
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+
+def _wsi_worker(h5_path, wsi_path, schema, batch_size, num_threads, reader):
+    """
+    Run _process_one_wsi in a worker process and send its batches to the writer.
+    A None marker is sent last so the writer knows the WSI is finished, unless the run was aborted.
+    """
+    try:
+        for batch in _process_one_wsi(h5_path, wsi_path, schema, batch_size=batch_size,
+                                      num_threads=num_threads, reader=reader):
+            _put_batch(batch)
+    finally:
+        if not _abort_event.is_set():
+            _put_batch(None)
+
+
+def _put_batch(batch):
+    """
+    Send a batch to the writer, giving up once the run has been aborted.
+    """
+    while not _abort_event.is_set():
+        try:
+            _batch_queue.put(batch, timeout=QUEUE_POLL_INTERVAL)
+            return
+        except queue.Full:
+            continue
+    raise _WriteAborted("Run aborted")
+
+
+def _iter_batches(batch_queue, num_wsis, abort_event):
+    """
+    Yield the batches sent by the workers until the end marker of every WSI has been received.
+    Raises _WriteAborted once the run has been aborted, so that nothing is committed.
+    """
+    num_done = 0
+    while num_done < num_wsis:
+        if abort_event.is_set():
+            raise _WriteAborted("Run aborted")
+        try:
+            batch = batch_queue.get(timeout=QUEUE_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if batch is None:
+            num_done += 1
+            continue
+        yield batch
+
+
+def _write_batches(dataset_uri, schema, batch_queue, num_wsis, abort_event, done_event, errors):
+    """
+    Single consumer that streams the batches of all workers into one Lance dataset.
+    Writing through one write_dataset call lets Lance roll over to large fragments
+    instead of committing a small fragment per batch.
+    done_event is set once the write has finished or failed.
+    """
+    try:
+        reader = pa.RecordBatchReader.from_batches(schema, _iter_batches(batch_queue, num_wsis, abort_event))
+        lance.write_dataset(reader, dataset_uri, schema=schema, mode='overwrite',
+                            max_rows_per_file=MAX_ROWS_PER_FILE, data_storage_version=LANCE_STORAGE_VERSION)
+    except Exception as e:
+        if not abort_event.is_set():
+            errors.append(e)
+            # Nothing can be committed after a failed write, so abort the run
+            abort_event.set()
+    finally:
+        done_event.set()
+    
+    if abort_event.is_set():
+        # Discard whatever the workers still send while the run is torn down, so they
+        # never block on flushing the queue; the daemon thread ends with the process
+        try:
+            while True:
+                batch_queue.get()
+        except (EOFError, OSError):
+            # The queue has been closed
+            pass
+
+
+def process_h5_patches(h5_dir, wsi_dir, db_path="./lancedb", table_name="wsi_patches", num_workers=None,
+                       num_threads=8, image_encoding="jpeg", reader="openslide"):
     """
     Process all H5 files in a directory and load patches into LanceDB.
     Reads coordinates from H5 files and extracts patches from corresponding WSI files.
+    WSIs are processed in parallel worker processes, while a single thread writes to the table.
     
     Args:
-        h5_dir: Directory containing H5 patch files
+        h5_dir: Directory containing H5 patch files (local or s3://)
         wsi_dir: Directory containing WSI files
         db_path: Path to the LanceDB database directory (default: "./lancedb")
         table_name: Name for the LanceDB table (default: "wsi_patches")
+        num_workers: Number of worker processes (default: number of CPUs divided by num_threads)
+        num_threads: Number of threads reading patches within each worker (default: 8)
+        image_encoding: "jpeg" to store JPEG encoded patches, or "raw" to store the RGB pixels
+            as bytes that Lance compresses with zstd; all WSIs must then share one patch size (default: "jpeg")
+        reader: "openslide", or "tifffile" to slice pyramidal TIFFs through zarr; the coordinates
+            must then lie on the pixel grid of the patch level (default: "openslide")
     """
     # Find all H5 files
-    h5_files = [f for f in os.listdir(h5_dir) if f.endswith('.h5')]
+    h5_paths = _list_h5_files(h5_dir)
     
-    if not h5_files:
+    if not h5_paths:
         raise ValueError(f"No H5 files found in {h5_dir}")
     
-    print(f"Found {len(h5_files)} H5 files to process")
-    
-    # Connect to LanceDB
-    db = lancedb.connect(db_path)
-    
-    # Define schema for the table
-    schema = pa.schema([
-        ('wsi_id', pa.string()),
-        ('patch_idx', pa.int64()),
-        ('coord_x', pa.int64()),
-        ('coord_y', pa.int64()),
-        ('image', pa.binary())
-    ])
-    
-    # Create table (will overwrite if exists)
-    try:
-        table = db.create_table(table_name, schema=schema, mode='overwrite')
-        print(f"Created table: {table_name}")
-    except Exception as e:
-        print(f"Table might already exist, trying to open: {e}")
-        table = db.open_table(table_name)
+    print(f"Found {len(h5_paths)} H5 files to process")
     
-    # Process H5 files and insert data
-    for h5_filename in tqdm(h5_files, desc="Processing H5 files"):
-        h5_path = os.path.join(h5_dir, h5_filename)
-        
+    # Pair every H5 file with its WSI file
+    wsi_index = _index_wsi_files(wsi_dir)
+    tasks = []
+    for h5_path in h5_paths:
         # Extract WSI ID from H5 filename (remove .h5 extension)
-        wsi_id = os.path.splitext(h5_filename)[0]
+        wsi_id = os.path.splitext(os.path.basename(h5_path))[0]
         
         # Find corresponding WSI file
-        wsi_path = find_wsi_file(wsi_dir, wsi_id)
-        if not os.path.exists(wsi_path):
-            print(f"Warning: Could not find WSI file for {wsi_id} at {wsi_path}, skipping")
+        wsi_path = wsi_index.get(wsi_id)
+        if wsi_path is None:
+            logger.warning(f"Could not find WSI file for {wsi_id} in {wsi_dir}, skipping")
             continue
         
-        try:
-            # Open WSI file
-            wsi = openslide.OpenSlide(wsi_path)
-            
-            # Read coordinates and metadata from H5 file
-            with h5py.File(h5_path, 'r') as hdf5_file:
-                if 'coords' not in hdf5_file:
-                    print(f"Warning: {h5_filename} missing 'coords' dataset, skipping")
-                    wsi.close()
-                    continue
-                
-                coords = hdf5_file['coords']
-                
-                # Get patch metadata from H5 attributes
-                if 'patch_level' in coords.attrs:
-                    patch_level = int(coords.attrs['patch_level'])
-                else:
-                    patch_level = 0  # Default to level 0
-                
-                if 'patch_size' in coords.attrs:
-                    patch_size = int(coords.attrs['patch_size'])
-                else:
-                    patch_size = 256  # Default patch size
-                
-                num_patches = len(coords)
-                print(f"Processing {num_patches} patches from {wsi_id} (level={patch_level}, size={patch_size})")
-                
-                # Process in batches for efficiency
-                batch_size = 1000
-                for batch_start in range(0, num_patches, batch_size):
-                    batch_end = min(batch_start + batch_size, num_patches)
-                    
-                    # Prepare batch data as list of dictionaries
-                    batch_data = []
-                    
-                    for idx in range(batch_start, batch_end):
-                        coord = coords[idx]
-                        coord_tuple = (int(coord[0]), int(coord[1]))
-                        
-                        # Extract patch from WSI using read_region
-                        # read_region takes (x, y) at level 0, level, and size
-                        patch_img = wsi.read_region(coord_tuple, patch_level, (patch_size, patch_size))
-                        patch_img = patch_img.convert('RGB')
-                        
-                        # Convert PIL Image to binary (JPEG format)
-                        img_bytes = io.BytesIO()
-                        patch_img.save(img_bytes, format='JPEG')
-                        img_binary = img_bytes.getvalue()
-                        
-                        # Create record
-                        batch_data.append({
-                            'wsi_id': wsi_id,
-                            'patch_idx': idx,
-                            'coord_x': coord_tuple[0],
-                            'coord_y': coord_tuple[1],
-                            'image': img_binary
-                        })
-                    
-                    # Insert batch into LanceDB
-                    table.add(batch_data)
+        tasks.append((h5_path, wsi_path))
+    
+    if num_workers is None:
+        num_workers = max(1, os.cpu_count() // num_threads)
+    
+    batch_size = 1000
+    queue_size = 4 * num_workers
+    patch_size = 256
+    if image_encoding == 'raw':
+        # The patch size of raw patches is fixed for the whole table, so check all H5 files before starting
+        patch_sizes = {}
+        for h5_path, _ in tasks:
+            coords_info = _read_coords(h5_path, metadata_only=True)
+            if coords_info is not None:
+                patch_sizes.setdefault(coords_info[2], []).append(os.path.basename(h5_path))
+        if len(patch_sizes) > 1:
+            found = ', '.join(f"{size} ({len(names)} files, e.g. {names[0]})"
+                              for size, names in sorted(patch_sizes.items()))
+            raise ValueError(f"Raw patches need one patch size for all H5 files, found {found}")
+        if patch_sizes:
+            patch_size = next(iter(patch_sizes))
+        
+        # Bound batches and the queue by bytes, since raw patches are large
+        patch_bytes = patch_size * patch_size * 3
+        batch_size = max(1, min(batch_size, RAW_BATCH_BYTES // patch_bytes))
+        queue_size = max(2, min(queue_size, RAW_QUEUE_BYTES // (batch_size * patch_bytes)))
+    schema = _patch_schema(image_encoding, patch_size)
+    
+    # forkserver avoids forking the parent with its LanceDB state and heavy imports
+    mp_context = mp.get_context('forkserver')
+    # Bounded queue so workers cannot run arbitrarily far ahead of the writer
+    batch_queue = mp_context.Queue(maxsize=queue_size)
+    
+    # Process H5 files in worker processes and write data from a single writer thread.
+    # The table is written as a Lance dataset inside the LanceDB directory (will overwrite if exists)
+    dataset_uri = os.path.join(db_path, f"{table_name}.lance")
+    write_errors = []
+    abort_event = mp_context.Event()
+    write_done = threading.Event()
+    writer = threading.Thread(target=_write_batches, daemon=True,
+                              args=(dataset_uri, schema, batch_queue, len(tasks), abort_event, write_done, write_errors))
+    writer.start()
+    
+    executor = ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context,
+                                   initializer=_init_worker, initargs=(batch_queue, abort_event))
+    try:
+        futures = {
+            executor.submit(_wsi_worker, h5_path, wsi_path, schema, batch_size, num_threads, reader): h5_path
+            for h5_path, wsi_path in tasks
+        }
+        
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing H5 files",
+                           mininterval=0.5):
+            # Stop right away after a failed write instead of processing the remaining WSIs
+            if write_errors:
+                raise write_errors[0]
             
-            wsi.close()
+            e = future.exception()
+            if e is not None:
+                logger.error(f"Error processing {os.path.basename(futures[future])}: {e}", exc_info=e)
+                # A crashed worker can leave the queue in an unusable state, so the run cannot be completed
+                if isinstance(e, BrokenProcessPool):
+                    raise e
         
-        except Exception as e:
-            print(f"Error processing {h5_filename}: {e}")
-            import traceback
-            traceback.print_exc()
-            continue
+        # The writer keeps draining the queue after a failed write, so wait for the write itself
+        write_done.wait()
+        if write_errors:
+            raise write_errors[0]
+    except BaseException:
+        # Stop the writer and the workers instead of waiting for the remaining WSIs
+        abort_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
     
-    print(f"Successfully loaded patches into LanceDB table: {table_name}")
+    # Re-open the written dataset as a LanceDB table
+    db = lancedb.connect(db_path)
+    table = db.open_table(table_name)
+    
+    print(f"Successfully loaded {len(table)} patches into LanceDB table: {table_name}")
 
 
 def load_from_lance(db_path, table_name, limit=None):
@@ -177,7 +746,7 @@ if __name__ == "__main__":
         "--h5_dir",
         type=str,
         required=True,
-        help="Directory containing H5 patch files"
+        help="Directory containing H5 patch files (local or s3://)"
     )
     parser.add_argument(
         "--wsi_dir",
@@ -197,6 +766,33 @@ if __name__ == "__main__":
         default="wsi_patches",
         help="Name for the LanceDB table (default: wsi_patches)"
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs divided by --num_threads)"
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=8,
+        help="Number of threads reading patches within each worker process (default: 8)"
+    )
+    parser.add_argument(
+        "--image_encoding",
+        type=str,
+        choices=["jpeg", "raw"],
+        default="jpeg",
+        help="Store patches as JPEG bytes or as raw RGB bytes compressed by Lance with zstd (default: jpeg)"
+    )
+    parser.add_argument(
+        "--reader",
+        type=str,
+        choices=["openslide", "tifffile"],
+        default="openslide",
+        help="Library used to read the WSI files; tifffile slices pyramidal TIFFs through zarr and "
+             "needs coordinates on the pixel grid of the patch level (default: openslide)"
+    )
     parser.add_argument(
         "--verify",
         action="store_true",
@@ -205,7 +801,9 @@ if __name__ == "__main__":
     
     args = parser.parse_args()
     
-    if not os.path.isdir(args.h5_dir):
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    
+    if not args.h5_dir.startswith('s3://') and not os.path.isdir(args.h5_dir):
         print(f"Error: Directory {args.h5_dir} does not exist")
         exit(1)
     
@@ -214,7 +812,9 @@ if __name__ == "__main__":
         exit(1)
     
     start = time.time()
-    process_h5_patches(args.h5_dir, args.wsi_dir, args.db_path, args.table_name)
+    process_h5_patches(args.h5_dir, args.wsi_dir, args.db_path, args.table_name,
+                       args.num_workers, args.num_threads, args.image_encoding,
+                       args.reader)
     end = time.time()
     print(f"\nTime taken: {end - start:.2f} seconds")
     
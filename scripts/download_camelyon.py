@@ -11,61 +11,112 @@ S3 Bucket: s3://camelyon-dataset
 """
 
 import argparse
+import json
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore import UNSIGNED
 from botocore.config import Config
 from tqdm import tqdm
 
+# Sidecar file in the destination directory recording the ETag of every downloaded key
+ETAG_MANIFEST = '.etags.json'
 
-def download_file(s3_client, bucket_name, s3_key, local_path):
-    """Download a single file from S3 with progress bar."""
-    # Get file size for progress bar
-    try:
-        response = s3_client.head_object(Bucket=bucket_name, Key=s3_key)
-        file_size = response['ContentLength']
-    except Exception as e:
-        print(f"Warning: Could not get file size for {s3_key}: {e}")
-        file_size = None
 
+class DownloadCancelled(Exception):
+    """Raised from the progress callback to stop a running transfer."""
+
+
+def download_file(s3_client, bucket_name, s3_key, local_path, file_size, transfer_config=None,
+                  cancel_event=None):
+    """
+    Download a single file of known size (from the bucket listing) from S3 with progress bar.
+    The transfer stops at its next chunk once cancel_event is set.
+    """
     # Create directory if it doesn't exist
     local_path.parent.mkdir(parents=True, exist_ok=True)
 
     # Download with progress bar
     try:
+        # Redraw at most every 0.5 s and every 1% (at least 1 MB), not on every transferred chunk
         with tqdm(total=file_size, unit='B', unit_scale=True, unit_divisor=1024, 
-                  desc=os.path.basename(s3_key), leave=False) as pbar:
+                  desc=os.path.basename(s3_key), leave=False,
+                  mininterval=0.5, miniters=max((file_size or 0) // 100, 1024 * 1024)) as pbar:
             def callback(bytes_amount):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise DownloadCancelled()
                 pbar.update(bytes_amount)
             
             s3_client.download_file(
                 bucket_name, 
                 s3_key, 
                 str(local_path),
-                Callback=callback
+                Callback=callback,
+                Config=transfer_config
             )
         return True
+    except DownloadCancelled:
+        return False
     except Exception as e:
         print(f"Error downloading {s3_key}: {e}")
         return False
 
 
+def load_etag_manifest(dest_path):
+    """Load the {key: ETag} manifest of files downloaded by previous runs."""
+    manifest_path = dest_path / ETAG_MANIFEST
+    if not manifest_path.exists():
+        return {}
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if not isinstance(manifest, dict):
+            raise ValueError(f"expected a JSON object, got {type(manifest).__name__}")
+        return manifest
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read {manifest_path}, ignoring it: {e}")
+        return {}
+
+
+def save_etag_manifest(dest_path, manifest):
+    """Atomically write the {key: ETag} manifest of downloaded files."""
+    manifest_path = dest_path / ETAG_MANIFEST
+    tmp_path = manifest_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
 def list_s3_objects(s3_client, bucket_name, prefix=''):
-    """List all objects in the S3 bucket."""
+    """List all objects below a prefix in the S3 bucket. Listing errors are raised to the caller."""
     objects = []
     paginator = s3_client.get_paginator('list_objects_v2')
     
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        if 'Contents' in page:
+            objects.extend(page['Contents'])
+    return objects
+
+
+def list_s3_prefixes(s3_client, bucket_name, prefix=''):
+    """List the objects and sub-prefixes directly below a prefix in the S3 bucket."""
+    objects = []
+    prefixes = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    
     try:
-        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-            if 'Contents' in page:
-                objects.extend(page['Contents'])
-        return objects
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+            objects.extend(page.get('Contents', []))
+            prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        return objects, prefixes
     except Exception as e:
-        print(f"Error listing objects in bucket: {e}")
-        return []
+        print(f"Error listing prefixes in bucket: {e}")
+        return [], []
 
 
 def main():
@@ -89,6 +140,18 @@ Examples:
         default='',
         help='Optional S3 prefix to download only specific subdirectories (default: download everything)'
     )
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=8,
+        help='Number of files downloaded in parallel (default: 8)'
+    )
+    parser.add_argument(
+        '--max_concurrency',
+        type=int,
+        default=16,
+        help='Number of parallel range requests per large file (default: 16)'
+    )
     
     args = parser.parse_args()
     
@@ -99,57 +162,130 @@ Examples:
     print(f"Destination directory: {dest_path}")
     print("Connecting to S3...")
     
-    # Create S3 client with unsigned config (no credentials needed for public bucket)
+    # Create S3 client with unsigned config (no credentials needed for public bucket).
+    # The client is shared by all download threads and their multipart transfers,
+    # so allow enough pooled connections
     s3_client = boto3.client(
         's3',
-        config=Config(signature_version=UNSIGNED),
+        config=Config(
+            signature_version=UNSIGNED,
+            max_pool_connections=args.num_workers * args.max_concurrency,
+            retries={'mode': 'adaptive', 'total_max_attempts': 10}
+        ),
         region_name='us-west-2'
     )
     
     bucket_name = 'camelyon-dataset'
     
-    # List all objects in the bucket
-    print("Listing files in S3 bucket...")
-    objects = list_s3_objects(s3_client, bucket_name, prefix=args.prefix)
-    
-    if not objects:
-        print("No files found in the bucket.")
-        sys.exit(1)
-    
-    print(f"Found {len(objects)} files to download.")
+    # Fetch large WSIs with parallel ranged GETs instead of a single stream
+    transfer_config = TransferConfig(
+        multipart_threshold=8 * 1024 * 1024,
+        multipart_chunksize=16 * 1024 * 1024,
+        max_concurrency=args.max_concurrency,
+        use_threads=True
+    )
     
-    # Download all files
     successful = 0
     failed = 0
+    failed_listings = 0
+    futures = {}
+    cancel_event = threading.Event()
     
-    for obj in tqdm(objects, desc="Downloading files"):
-        s3_key = obj['Key']
-        
-        # Skip if it's a directory (ends with /)
-        if s3_key.endswith('/'):
-            continue
-        
-        # Create local file path
-        local_file_path = dest_path / s3_key
-        
-        # Skip if file already exists
-        if local_file_path.exists():
-            file_size = obj.get('Size', 0)
-            if local_file_path.stat().st_size == file_size:
-                tqdm.write(f"Skipping {s3_key} (already exists)")
+    # ETags of the files downloaded by previous runs, so unchanged files are skipped without a stat
+    etag_manifest = load_etag_manifest(dest_path)
+    
+    def submit_downloads(executor, objects):
+        """Submit a download for every object that is not present locally yet."""
+        nonlocal successful
+        for obj in objects:
+            s3_key = obj['Key']
+            etag = obj.get('ETag')
+            
+            # Skip if it's a directory (ends with /)
+            if s3_key.endswith('/'):
+                continue
+            
+            # Skip if the same version of the file was downloaded before
+            if etag is not None and etag_manifest.get(s3_key) == etag:
                 successful += 1
                 continue
-        
-        # Download the file
-        if download_file(s3_client, bucket_name, s3_key, local_file_path):
-            successful += 1
-        else:
-            failed += 1
+            
+            # Create local file path
+            local_file_path = dest_path / s3_key
+            
+            # Size as reported by the listing, so no extra request per file is needed
+            file_size = obj.get('Size')
+            
+            # Skip if file already exists (e.g. downloaded before the manifest was introduced)
+            if s3_key not in etag_manifest and local_file_path.exists():
+                if local_file_path.stat().st_size == file_size:
+                    tqdm.write(f"Skipping {s3_key} (already exists)")
+                    etag_manifest[s3_key] = etag
+                    successful += 1
+                    continue
+            
+            # Download the file
+            future = executor.submit(download_file, s3_client, bucket_name, s3_key, local_file_path,
+                                     file_size, transfer_config, cancel_event)
+            futures[future] = (s3_key, etag)
+    
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        # Record the downloaded files in the manifest even if the run is interrupted
+        try:
+            # List the top level of the prefix, then its sub-prefixes in parallel.
+            # Downloads of each sub-prefix start as soon as its listing arrives
+            print("Listing files in S3 bucket...")
+            objects, prefixes = list_s3_prefixes(s3_client, bucket_name, prefix=args.prefix)
+            num_objects = len(objects)
+            submit_downloads(executor, objects)
+            
+            with ThreadPoolExecutor(max_workers=16) as list_executor:
+                list_futures = {
+                    list_executor.submit(list_s3_objects, s3_client, bucket_name, sub_prefix): sub_prefix
+                    for sub_prefix in prefixes
+                }
+                for list_future in as_completed(list_futures):
+                    try:
+                        objects = list_future.result()
+                    except Exception as e:
+                        # The files below this prefix are missing from the download, so the run fails at the end
+                        print(f"Error listing objects in {list_futures[list_future]}: {e}")
+                        failed_listings += 1
+                        continue
+                    num_objects += len(objects)
+                    submit_downloads(executor, objects)
+            
+            if num_objects == 0:
+                print("No files found in the bucket.")
+                sys.exit(1)
+            
+            print(f"Found {num_objects} files to download.")
+            
+            # Download all files
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading files",
+                               mininterval=0.5):
+                if future.result():
+                    s3_key, etag = futures[future]
+                    etag_manifest[s3_key] = etag
+                    successful += 1
+                else:
+                    failed += 1
+        except BaseException:
+            # Stop the running downloads at their next chunk and drop the queued ones,
+            # so leaving the executor does not wait for whole transfers
+            cancel_event.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            save_etag_manifest(dest_path, etag_manifest)
     
     print(f"\nDownload complete!")
     print(f"Successfully downloaded: {successful} files")
     if failed > 0:
         print(f"Failed: {failed} files")
+    if failed_listings > 0:
+        print(f"Failed to list: {failed_listings} prefixes")
+    if failed > 0 or failed_listings > 0:
         sys.exit(1)
 
 